@@ -10,8 +10,10 @@ from werkzeug.utils import secure_filename
 import time
 from datetime import timedelta
 import threading
+import atexit
 import shutil
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import sqlite3
 import json
 from mutagen.easyid3 import EasyID3
@@ -27,6 +29,15 @@ import tempfile
 import zipfile
 import stat
 import platform
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    from gevent import monkey as gevent_monkey
+    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+except ImportError:  # Development server without gevent
+    gevent_monkey = None
 import re
 import shutil
 import sqlite3
@@ -43,6 +54,15 @@ app.config['TEMP_FOLDER'] = os.path.join(app.config['DOWNLOAD_FOLDER'], 'temp')
 app.config['MAX_FILE_AGE'] = timedelta(hours=24)  # Files older than this will be deleted
 app.config['THUMBNAIL_FOLDER'] = os.path.join(app.config['DOWNLOAD_FOLDER'], 'thumbnails')
 app.config['DATABASE'] = os.path.join(app.config['DOWNLOAD_FOLDER'], 'media.db')
+app.config['JOB_MAX_ATTEMPTS'] = 3  # Times an interrupted download is resumed before it is rolled back
+app.config['BATCH_MAX_URLS'] = 500  # Max URLs accepted by /api/video-info/batch
+app.config['INFO_WORKERS'] = 4  # Threads for single lookups (/api/video-info, download titles) on a worker
+app.config['BATCH_WORKERS'] = 8  # Threads for /api/video-info/batch, shared by all batches on a worker
+app.config['BATCH_IN_FLIGHT'] = 4  # Lookups one batch request may have queued or running at once
+app.config['DOWNLOAD_WORKERS'] = 4  # Threads running download jobs on a worker
+app.config['DB_TIMEOUT'] = 5  # Seconds to wait on a locked database for library and journal writes
+app.config['RATE_LIMIT_DB_TIMEOUT'] = 0.25  # Busy wait for the rate-limit check, which fails open
+app.config['WORKER_FOLDER'] = os.path.join(app.config['DOWNLOAD_FOLDER'], 'workers')
 
 # Quality presets
 QUALITY_PRESETS = {
@@ -80,13 +100,16 @@ for folder in [
     app.config['AUDIO_FOLDER'],
     app.config['VIDEO_FOLDER'],
     app.config['TEMP_FOLDER'],
-    app.config['THUMBNAIL_FOLDER']
+    app.config['THUMBNAIL_FOLDER'],
+    app.config['WORKER_FOLDER']
 ]:
     os.makedirs(folder, exist_ok=True)
 
 # Initialize database
 def init_db():
     with sqlite3.connect(app.config['DATABASE']) as conn:
+        # WAL lets several server workers read while one of them writes
+        conn.execute('PRAGMA journal_mode=WAL')
         conn.execute('''
             CREATE TABLE IF NOT EXISTS media (
                 id TEXT PRIMARY KEY,
@@ -121,13 +144,54 @@ def init_db():
                 FOREIGN KEY (media_id) REFERENCES media(id)
             )
         ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                media_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                type TEXT,
+                quality TEXT,
+                folder TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                path TEXT,
+                title TEXT,
+                author TEXT,
+                duration INTEGER,
+                thumbnail TEXT,
+                youtube_id TEXT,
+                options TEXT,
+                metadata INTEGER DEFAULT 1,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                pid INTEGER,
+                owner TEXT,
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Columns added after the jobs table first shipped
+        job_columns = {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+        for column, definition in (('options', 'TEXT'), ('metadata', 'INTEGER DEFAULT 1'),
+                                   ('owner', 'TEXT'), ('attempts', 'INTEGER DEFAULT 0')):
+            if column not in job_columns:
+                conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                key TEXT NOT NULL,
+                ts REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_rate_limits_key ON rate_limits (key, ts)')
         conn.commit()
 
 init_db()
 
 # Database functions
-def get_db():
-    return sqlite3.connect(app.config['DATABASE'])
+def get_db(timeout=None):
+    return sqlite3.connect(app.config['DATABASE'], timeout=timeout or app.config['DB_TIMEOUT'])
 
 def add_media_to_db(media_data):
     try:
@@ -182,6 +246,25 @@ def get_all_media_from_db():
         logger.error(f"Error getting all media from database: {str(e)}")
         return []
 
+def get_media_by_youtube_ids(youtube_ids):
+    """Return the newest library entry for each of the given YouTube ids, keyed by id"""
+    if not youtube_ids:
+        return {}
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            placeholders = ','.join('?' * len(youtube_ids))
+            cursor.execute(f'''
+                SELECT * FROM media WHERE youtube_id IN ({placeholders})
+                ORDER BY created_at ASC
+            ''', list(youtube_ids))
+            rows = cursor.fetchall()
+            columns = [column[0] for column in cursor.description]
+            return {row['youtube_id']: row for row in (dict(zip(columns, r)) for r in rows)}
+    except Exception as e:
+        logger.error(f"Error getting media by YouTube ids: {str(e)}")
+        return {}
+
 def delete_media_from_db(media_id):
     try:
         with get_db() as conn:
@@ -218,20 +301,522 @@ def get_storage_info():
             'free': 0
         }
 
+# Executors
+# Under gunicorn's gevent worker every request shares one OS thread (the hub),
+# so CPU-bound work (yt-dlp extraction and its JS interpreter, mutagen tagging)
+# would stall every connection on the worker. It runs on native threads instead;
+# the waiting greenlet yields until the result is ready.
+def make_executor(max_workers, name):
+    """Thread pool whose workers are real OS threads, even when threading is monkey-patched"""
+    if gevent_monkey is not None and gevent_monkey.is_module_patched('threading'):
+        return NativeThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+download_executor = make_executor(app.config['DOWNLOAD_WORKERS'], 'download')
+
+# Worker identity
+# Jobs are owned by a per-process id rather than a pid, since pids are reused
+# across container restarts and can match a sibling worker. Each process holds
+# an flock on workers/<id>.lock for its lifetime, so the lock being free means
+# the owner is gone.
+WORKER_ID = uuid.uuid4().hex
+_worker_lock = None
+
+def worker_lock_path(worker_id):
+    return os.path.join(app.config['WORKER_FOLDER'], f'{worker_id}.lock')
+
+def hold_worker_lock():
+    global _worker_lock
+    if fcntl is None:
+        return
+    _worker_lock = open(worker_lock_path(WORKER_ID), 'w')
+    fcntl.flock(_worker_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def is_worker_alive(worker_id, pid):
+    if worker_id == WORKER_ID:
+        return True
+    if fcntl is None or not worker_id:
+        return is_process_alive(pid)
+    lock_path = worker_lock_path(worker_id)
+    try:
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True
+    except FileNotFoundError:
+        return False
+    # The owner exited; its lock file can go
+    try:
+        os.remove(lock_path)
+    except OSError:
+        pass
+    return False
+
+def reap_worker_locks(min_age=60):
+    """Remove lock files left by workers that exited without owning a running job"""
+    if fcntl is None:
+        return
+    now = time.time()
+    for filename in os.listdir(app.config['WORKER_FOLDER']):
+        worker_id, ext = os.path.splitext(filename)
+        lock_path = os.path.join(app.config['WORKER_FOLDER'], filename)
+        try:
+            # Skip young files: a starting worker may not hold its lock yet
+            if ext != '.lock' or now - os.path.getmtime(lock_path) < min_age:
+                continue
+        except OSError:
+            continue
+        is_worker_alive(worker_id, None)
+
+hold_worker_lock()
+
+# Job journal
+# Every download is journaled stage by stage so that a crash or restart in the
+# middle of a request can be resumed or rolled back on the next startup instead
+# of leaving orphaned .part/.webp files for the hourly sweep to find a day later.
+JOB_STAGES = ('extracted', 'downloading', 'downloaded', 'merged', 'tagged', 'registered')
+
+# Postprocessors (by pp_key, as reported to postprocessor_hooks) whose
+# completion means the final media file exists
+JOB_MERGE_POSTPROCESSORS = ('Merger', 'ExtractAudio')
+
+def _job_from_row(columns, row):
+    job = dict(zip(columns, row))
+    job['options'] = json.loads(job['options']) if job.get('options') else {}
+    return job
+
+def create_job(job_data):
+    try:
+        with get_db() as conn:
+            conn.execute('''
+                INSERT INTO jobs (id, media_id, url, type, quality, folder, filename,
+                                  title, author, duration, thumbnail, youtube_id,
+                                  options, metadata, stage, pid, owner)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'extracted', ?, ?)
+            ''', (
+                job_data['id'],
+                job_data['media_id'],
+                job_data['url'],
+                job_data.get('type'),
+                job_data.get('quality'),
+                job_data['folder'],
+                job_data['filename'],
+                job_data.get('title'),
+                job_data.get('author'),
+                job_data.get('duration'),
+                job_data.get('thumbnail'),
+                job_data.get('youtube_id'),
+                json.dumps(job_data.get('options') or {}),
+                1 if job_data.get('metadata', True) else 0,
+                os.getpid(),
+                WORKER_ID
+            ))
+            conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"Error creating job {job_data.get('id')}: {str(e)}")
+        return False
+
+def update_job_stage(job_id, stage, path=None):
+    try:
+        with get_db() as conn:
+            conn.execute('''
+                UPDATE jobs
+                SET stage = ?, path = COALESCE(?, path), updated_at = CURRENT_TIMESTAMP,
+                    status = CASE WHEN ? = 'registered' THEN 'done' ELSE status END
+                WHERE id = ?
+            ''', (stage, path, stage, job_id))
+            conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"Error updating job {job_id} to {stage}: {str(e)}")
+        return False
+
+def fail_job(job_id, error):
+    try:
+        with get_db() as conn:
+            conn.execute('''
+                UPDATE jobs SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (error, job_id))
+            conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"Error marking job {job_id} as failed: {str(e)}")
+        return False
+
+def get_job(job_id):
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+            if row:
+                columns = [column[0] for column in cursor.description]
+                return _job_from_row(columns, row)
+        return None
+    except Exception as e:
+        logger.error(f"Error getting job {job_id}: {str(e)}")
+        return None
+
+def get_unfinished_jobs():
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM jobs WHERE status = 'running' ORDER BY created_at")
+            rows = cursor.fetchall()
+            if rows:
+                columns = [column[0] for column in cursor.description]
+                return [_job_from_row(columns, row) for row in rows]
+        return []
+    except Exception as e:
+        logger.error(f"Error getting unfinished jobs: {str(e)}")
+        return []
+
+def get_job_files(job):
+    """Files on disk written by this job (.part, .ytdl, .fNNN streams, thumbnail, output)
+
+    Output names always end in the job's own id suffix, so the prefix cannot
+    match another download's files.
+    """
+    prefix = job['filename'] + '.'
+    try:
+        filenames = os.listdir(job['folder'])
+    except OSError:
+        return []
+    return [
+        os.path.join(job['folder'], filename)
+        for filename in filenames
+        if filename.startswith(prefix) and os.path.isfile(os.path.join(job['folder'], filename))
+    ]
+
+def remove_job_files(job, keep=None):
+    """Delete the files a job left behind, except `keep` and anything in the library"""
+    files = get_job_files(job)
+    if not files:
+        return 0
+    protected = {os.path.abspath(keep)} if keep else set()
+    try:
+        with get_db() as conn:
+            placeholders = ','.join('?' * len(files))
+            rows = conn.execute(f'SELECT path FROM media WHERE path IN ({placeholders})', files).fetchall()
+            protected.update(os.path.abspath(row[0]) for row in rows)
+    except Exception as e:
+        # Without the library we cannot tell what is safe to delete
+        logger.error(f"Error checking library paths for job {job['id']}: {str(e)}")
+        return 0
+
+    removed = 0
+    for file_path in files:
+        if os.path.abspath(file_path) in protected:
+            continue
+        try:
+            os.remove(file_path)
+            removed += 1
+        except Exception as e:
+            logger.error(f"Error deleting job file {file_path}: {str(e)}")
+    return removed
+
+def is_process_alive(pid):
+    if not pid or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+def parse_time(time_str):
+    parts = list(map(int, time_str.split(':')))
+    if len(parts) == 3:  # HH:MM:SS
+        return parts[0] * 3600 + parts[1] * 60 + parts[2]
+    elif len(parts) == 2:  # MM:SS
+        return parts[0] * 60 + parts[1]
+    return int(time_str)  # SS
+
+def build_download_options(download_type, quality, trim_start=None, trim_end=None):
+    """The yt-dlp options that define a job; journaled so the job can be re-run"""
+    options = {
+        'postprocessors': [],
+        'merge_output_format': 'mp4',
+        'writethumbnail': True
+    }
+    
+    # Configure format selection
+    if download_type == 'audio':
+        options.update({
+            'format': 'bestaudio/best',
+            'postprocessors': [
+                {
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': 'mp3',
+                    'preferredquality': '192',
+                },
+                {
+                    'key': 'FFmpegMetadata',
+                    'add_metadata': True
+                }
+            ]
+        })
+    else:
+        if quality == 'highest':
+            options['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+        else:
+            res = quality.replace('p', '')
+            options['format'] = f'bestvideo[height<={res}][ext=mp4]+bestaudio[ext=m4a]/best[height<={res}][ext=mp4]/best'
+    
+    # Handle video trimming
+    pre_opts = []
+    if trim_start:
+        pre_opts += ['-ss', str(parse_time(trim_start))]
+    if trim_end:
+        pre_opts += ['-to', str(parse_time(trim_end))]
+    if pre_opts:
+        options['postprocessors'].append({
+            'key': 'FFmpegVideoConvertor',
+            'preferedformat': 'mp4',
+            'when': 'before_dl',
+            'pre_opts': pre_opts
+        })
+    return options
+
+def tag_media_file(path, download_type, title, author):
+    try:
+        if download_type == 'audio':
+            audio = MP3(path, ID3=EasyID3)
+            audio['title'] = title
+            audio['artist'] = author or 'Unknown'
+            audio['album'] = 'YouTube Download'
+            audio.save()
+            
+            # Add thumbnail
+            audio = MP3(path, ID3=ID3)
+            thumb_path = path.replace('.mp3', '.webp')
+            if os.path.exists(thumb_path):
+                with open(thumb_path, 'rb') as thumb_file:
+                    audio.tags.add(APIC(
+                        encoding=3,
+                        mime='image/webp',
+                        type=3,
+                        desc='Cover',
+                        data=thumb_file.read()
+                    ))
+                    audio.save()
+                os.remove(thumb_path)
+        else:
+            video = MP4(path)
+            video['\xa9nam'] = title
+            video['\xa9ART'] = author or 'Unknown'
+            thumb_path = path.replace('.mp4', '.webp')
+            if os.path.exists(thumb_path):
+                with open(thumb_path, 'rb') as thumb_file:
+                    video['covr'] = [MP4Cover(thumb_file.read(), imageformat=MP4Cover.FORMAT_JPEG)]
+                os.remove(thumb_path)
+            video.save()
+    except Exception as e:
+        logger.warning(f"Metadata error: {str(e)}")
+
+def finalize_job(job, path):
+    """Tag, register and tidy up a job whose output file is complete"""
+    if job['metadata'] and job['stage'] != 'tagged':
+        tag_media_file(path, job['type'], job['title'], job['author'])
+    job['stage'] = 'tagged'
+    update_job_stage(job['id'], 'tagged')
+    
+    if not get_media_from_db(job['media_id']):
+        media_data = {
+            'id': job['media_id'],
+            'title': job['title'] or job['filename'],
+            'author': job['author'],
+            'duration': job['duration'],
+            'size': os.path.getsize(path),
+            'format': 'mp3' if job['type'] == 'audio' else 'mp4',
+            'type': job['type'],
+            'quality': job['quality'],
+            'thumbnail': job['thumbnail'],
+            'path': path,
+            'youtube_id': job['youtube_id']
+        }
+        if not add_media_to_db(media_data):
+            # Left running so the next startup retries the registration
+            return False
+    job['stage'] = 'registered'
+    update_job_stage(job['id'], 'registered')
+    remove_job_files(job, keep=path)
+    return True
+
+def run_download_job(job):
+    """Download, tag and register a journaled job; returns (info, path)
+
+    yt-dlp keeps `.part` files and resumes them (continuedl), so running the
+    same job again after an interruption picks up where the transfer stopped.
+    """
+    def set_stage(stage, path=None):
+        if stage != job['stage'] or path:
+            job['stage'] = stage
+            update_job_stage(job['id'], stage, path=path)
+    
+    def on_progress(d):
+        if d['status'] == 'downloading':
+            set_stage('downloading')
+        elif d['status'] == 'finished':
+            set_stage('downloaded')
+    
+    def on_postprocess(d):
+        if d['status'] != 'finished':
+            return
+        path = d.get('info_dict', {}).get('filepath')
+        if d.get('postprocessor') in JOB_MERGE_POSTPROCESSORS:
+            set_stage('merged', path=path)
+        elif path and job['stage'] == 'merged':
+            set_stage('merged', path=path)
+    
+    ydl_opts = dict(job['options'])
+    ydl_opts.update({
+        'quiet': True,
+        'no_warnings': True,
+        'outtmpl': os.path.join(job['folder'], job['filename'] + '.%(ext)s'),
+        'continuedl': True,
+        'progress_hooks': [on_progress],
+        'postprocessor_hooks': [on_postprocess],
+        'ffmpeg_location': resolve_ffmpeg_location()
+    })
+    
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(job['url'], download=True)
+        requested = info.get('requested_downloads') or [{}]
+        downloaded_file = requested[-1].get('filepath') or ydl.prepare_filename(info)
+        if job['type'] == 'audio':
+            downloaded_file = downloaded_file.replace('.webm', '.mp3').replace('.m4a', '.mp3')
+    
+    # Single-file downloads finish without a merge postprocessor
+    set_stage('merged', path=downloaded_file)
+    job.update({
+        'title': info.get('title') or job['title'],
+        'author': info.get('uploader'),
+        'duration': info.get('duration'),
+        'thumbnail': info.get('thumbnail'),
+        'youtube_id': info.get('id')
+    })
+    for attempt in range(3):
+        if finalize_job(job, downloaded_file):
+            break
+        logger.error(f"Failed to add media to database (attempt {attempt + 1})")
+        time.sleep(1)
+    else:
+        raise RuntimeError('Could not add the downloaded media to the library')
+    return info, downloaded_file
+
+def claim_job(job):
+    """Take ownership of an orphaned job; only one recovering worker can win"""
+    try:
+        with get_db() as conn:
+            cursor = conn.execute('''
+                UPDATE jobs SET owner = ?, pid = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'running' AND owner IS ?
+            ''', (WORKER_ID, os.getpid(), job['id'], job['owner']))
+            conn.commit()
+            return cursor.rowcount == 1
+    except Exception as e:
+        logger.error(f"Error claiming job {job['id']}: {str(e)}")
+        return False
+
+def finish_recovered_job(job, path):
+    stage = job['stage']
+    if finalize_job(job, path):
+        logger.info(f"Recovered job {job['id']} from stage '{stage}'")
+    else:
+        logger.error(f"Recovery could not register job {job['id']}; will retry on next start")
+
+def resume_download_job(job):
+    try:
+        with get_db() as conn:
+            conn.execute('''
+                UPDATE jobs SET attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (job['id'],))
+            conn.commit()
+        run_download_job(job)
+        logger.info(f"Resumed job {job['id']} completed")
+    except Exception as e:
+        logger.error(f"Resuming job {job['id']} failed: {str(e)}")
+        # Keep the .part files for the next start while attempts remain
+        if job['attempts'] + 1 >= app.config['JOB_MAX_ATTEMPTS']:
+            abort_job(job['id'], str(e))
+
+def recover_unfinished_jobs():
+    """Resume, roll forward or roll back jobs left running by a crashed or restarted worker.
+
+    Jobs that got as far as a finished output file are tagged and registered
+    (the media id is fixed when the job is created, so this is idempotent).
+    Interrupted transfers that left data on disk are re-run in the background
+    and continue from their .part files. Anything else is rolled back.
+    Every worker runs this on startup; claim_job makes sure each orphaned job
+    is handled by exactly one of them.
+    """
+    for job in get_unfinished_jobs():
+        # Another live worker still owns this job
+        if is_worker_alive(job['owner'], job['pid']):
+            continue
+        if not claim_job(job):
+            continue
+
+        path = job['path']
+        if (job['stage'] in ('merged', 'tagged') and path
+                and os.path.exists(path) and os.path.getsize(path) > 0):
+            download_executor.submit(finish_recovered_job, job, path)
+        elif (job['stage'] in ('downloading', 'downloaded') and get_job_files(job)
+                and job['options'] and job['attempts'] < app.config['JOB_MAX_ATTEMPTS']):
+            if not resolve_ffmpeg_location():
+                logger.error(f"FFmpeg unavailable; leaving job {job['id']} for the next start")
+                continue
+            logger.info(f"Resuming job {job['id']} from stage '{job['stage']}'")
+            download_executor.submit(resume_download_job, job)
+        else:
+            removed = remove_job_files(job)
+            fail_job(job['id'], f"Interrupted at stage '{job['stage']}'")
+            logger.info(f"Rolled back job {job['id']} from stage '{job['stage']}' ({removed} partial files removed)")
+    reap_worker_locks()
+
+def abort_job(job_id, error):
+    """Mark a running job as failed and reclaim whatever it left on disk"""
+    if not job_id:
+        return
+    try:
+        job = get_job(job_id)
+        if not job or job['status'] != 'running':
+            return
+        remove_job_files(job)
+        fail_job(job_id, error)
+    except Exception as e:
+        logger.error(f"Error aborting job {job_id}: {str(e)}")
+
 # Rate limiting decorator
+# Counts live in SQLite so the limit holds across all server workers
+def count_recent_requests(key, per):
+    now = time.time()
+    try:
+        with get_db(timeout=app.config['RATE_LIMIT_DB_TIMEOUT']) as conn:
+            conn.execute('DELETE FROM rate_limits WHERE key = ? AND ts <= ?', (key, now - per))
+            conn.execute('INSERT INTO rate_limits (key, ts) VALUES (?, ?)', (key, now))
+            count = conn.execute('SELECT COUNT(*) FROM rate_limits WHERE key = ?', (key,)).fetchone()[0]
+            conn.commit()
+        return count
+    except Exception as e:
+        # Fail open rather than reject traffic when the database is busy
+        logger.error(f"Error checking rate limit for {key}: {str(e)}")
+        return 0
+
 def rate_limit(limit=5, per=60):
     def decorator(f):
-        requests = []
-
         @wraps(f)
         def wrapped(*args, **kwargs):
-            now = time.time()
-            requests.append(now)
-            
-            # Remove old requests
-            requests[:] = [req for req in requests if now - req < per]
-            
-            if len(requests) > limit:
+            if count_recent_requests(f.__name__, per) > limit:
                 return jsonify({
                     'error': 'Too many requests',
                     'message': f'Rate limit exceeded: {limit} requests per {per} seconds'
@@ -260,14 +845,78 @@ def cleanup_old_files():
             logger.error(f"Error in cleanup thread: {str(e)}")
         time.sleep(3600)  
 
+_cleanup_lock = None
+
+def start_background_tasks():
+    """Start the cleanup sweep, once per host.
+
+    Every server worker imports this module, so an advisory lock on
+    downloads/.cleanup.lock elects a single worker to run the sweep.
+    """
+    global _cleanup_lock
+    if fcntl is not None:
+        lock_file = open(os.path.join(app.config['DOWNLOAD_FOLDER'], '.cleanup.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        _cleanup_lock = lock_file
+    cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
+    cleanup_thread.start()
+    return cleanup_thread
+
 # Start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
-cleanup_thread.start()
+start_background_tasks()
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# Fields returned by /api/video-info, in response order
+VIDEO_INFO_FIELDS = ('title', 'author', 'length', 'thumbnail_url', 'views', 'video_id', 'formats')
+# Fields that can be answered from the local media library without hitting YouTube
+LIBRARY_INFO_FIELDS = {'title', 'author', 'length', 'thumbnail_url', 'video_id'}
+
+YOUTUBE_ID_PATTERN = re.compile(r'(?:v=|youtu\.be/|/shorts/|/embed/|/live/)([\w-]{11})')
+
+def extract_youtube_id(url):
+    match = YOUTUBE_ID_PATTERN.search(url or '')
+    return match.group(1) if match else None
+
+def build_format_list(info):
+    formats = []
+    for f in info.get('formats') or []:
+        if f.get('vcodec') != 'none':  # Video formats
+            formats.append({
+                'itag': f['format_id'],
+                'resolution': f.get('resolution', 'unknown'),
+                'fps': f.get('fps'),
+                'ext': f['ext'],
+                'filesize': f.get('filesize')
+            })
+        elif f.get('acodec') != 'none':  # Audio formats
+            formats.append({
+                'itag': f['format_id'],
+                'abr': f.get('abr', 0),
+                'ext': f['ext'],
+                'filesize': f.get('filesize')
+            })
+    return formats
+
+def build_video_info(info, fields=VIDEO_INFO_FIELDS):
+    video_info = {
+        'title': info.get('title'),
+        'author': info.get('uploader'),
+        'length': info.get('duration'),
+        'thumbnail_url': info.get('thumbnail'),
+        'views': info.get('view_count'),
+        'video_id': info.get('id')
+    }
+    if 'formats' in fields:
+        video_info['formats'] = build_format_list(info)
+    return {field: video_info[field] for field in fields}
+
 @app.route('/api/video-info', methods=['GET'])
 def get_video_info():
     url = request.args.get('url')
@@ -275,47 +924,145 @@ def get_video_info():
         return jsonify({'error': 'URL parameter is required'}), 400
     
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            formats = []
-            for f in info['formats']:
-                if f.get('vcodec') != 'none':  # Video formats
-                    formats.append({
-                        'itag': f['format_id'],
-                        'resolution': f.get('resolution', 'unknown'),
-                        'fps': f.get('fps'),
-                        'ext': f['ext'],
-                        'filesize': f.get('filesize')
-                    })
-                elif f.get('acodec') != 'none':  # Audio formats
-                    formats.append({
-                        'itag': f['format_id'],
-                        'abr': f.get('abr', 0),
-                        'ext': f['ext'],
-                        'filesize': f.get('filesize')
-                    })
-            
-            return jsonify({
-                'title': info['title'],
-                'author': info.get('uploader'),
-                'length': info['duration'],
-                'thumbnail_url': info['thumbnail'],
-                'views': info.get('view_count'),
-                'video_id': info['id'],
-                'formats': formats
-            })
+        # Extraction is CPU-heavy; run it off the event loop on the shared info pool
+        video_info = info_executor.submit(fetch_video_info, url, VIDEO_INFO_FIELDS).result()
+        return jsonify(video_info)
             
     except Exception as e:
         logger.error(f"Error fetching video info: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Long-lived pools for video info lookups, shared by all requests on this worker.
+# Batches get their own pool so a large one cannot queue ahead of interactive
+# lookups. Each pool thread keeps one YoutubeDL open for its whole life
+# (instances are not thread-safe but are reusable); they are closed when the
+# process exits.
+info_executor = make_executor(app.config['INFO_WORKERS'], 'video-info')
+batch_executor = make_executor(app.config['BATCH_WORKERS'], 'video-info-batch')
+_info_ydl = threading.local()
+_info_ydls = []
+
+def _close_info_ydls():
+    info_executor.shutdown(wait=False, cancel_futures=True)
+    batch_executor.shutdown(wait=False, cancel_futures=True)
+    for ydl in _info_ydls:
+        try:
+            ydl.__exit__(None, None, None)
+        except Exception as e:
+            logger.error(f"Error closing YoutubeDL: {str(e)}")
+
+atexit.register(_close_info_ydls)
+
+def get_info_ydl():
+    ydl = getattr(_info_ydl, 'ydl', None)
+    if ydl is None:
+        ydl = _info_ydl.ydl = yt_dlp.YoutubeDL({
+            'quiet': True,
+            'no_warnings': True,
+            'extract_flat': False
+        }).__enter__()
+        _info_ydls.append(ydl)
+    return ydl
+
+def fetch_video_info(url, fields):
+    ydl = get_info_ydl()
+    info = ydl.extract_info(url, download=False, process=False)
+    # Plain video results already carry everything but the formats; redirects
+    # (youtu.be, url/url_transparent) and format requests need the full pass
+    if 'formats' in fields or info.get('_type', 'video') != 'video':
+        info = ydl.process_ie_result(info, download=False)
+    elif not info.get('thumbnail') and info.get('thumbnails'):
+        # Same ordering yt-dlp uses when it picks `thumbnail` during processing
+        thumbnails = sorted(info['thumbnails'], key=lambda t: (
+            t.get('preference') if t.get('preference') is not None else -1,
+            t.get('width') or -1,
+            t.get('height') or -1))
+        info['thumbnail'] = thumbnails[-1].get('url')
+    return build_video_info(info, fields)
+
+@app.route('/api/video-info/batch', methods=['POST'])
+@rate_limit(limit=10, per=60)
+def get_video_info_batch():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    urls = data.get('urls')
+    fields = data.get('fields')
+    
+    if not isinstance(urls, list) or not urls or not all(isinstance(url, str) for url in urls):
+        return jsonify({'error': 'urls must be a non-empty list of strings'}), 400
+    if len(urls) > app.config['BATCH_MAX_URLS']:
+        return jsonify({'error': f"At most {app.config['BATCH_MAX_URLS']} URLs per batch"}), 400
+    if fields is None:
+        fields = list(VIDEO_INFO_FIELDS)
+    if not isinstance(fields, list) or not fields or not all(isinstance(field, str) for field in fields):
+        return jsonify({'error': 'fields must be a non-empty list of strings'}), 400
+    unknown = [field for field in fields if field not in VIDEO_INFO_FIELDS]
+    if unknown:
+        return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+    fields = [field for field in VIDEO_INFO_FIELDS if field in fields]
+    
+    # Resolve each distinct URL once, but report against every position the caller sent it at
+    positions = {}
+    for index, url in enumerate(urls):
+        normalized = url.replace('%3D', '=').replace('%26', '&')
+        positions.setdefault(normalized, []).append(index)
+    
+    # Serve what we already have locally when the requested fields allow it
+    known = {}
+    if set(fields) <= LIBRARY_INFO_FIELDS:
+        youtube_ids = {url: extract_youtube_id(url) for url in positions}
+        library = get_media_by_youtube_ids({yid for yid in youtube_ids.values() if yid})
+        for url, yid in youtube_ids.items():
+            media = library.get(yid)
+            if media:
+                known[url] = {field: value for field, value in {
+                    'title': media['title'],
+                    'author': media['author'],
+                    'length': media['duration'],
+                    'thumbnail_url': media['thumbnail'],
+                    'video_id': media['youtube_id']
+                }.items() if field in fields}
+    
+    def lines(normalized, result):
+        for index in positions[normalized]:
+            yield json.dumps(dict(result, index=index, url=urls[index])) + '\n'
+    
+    def generate():
+        for normalized, info in known.items():
+            yield from lines(normalized, {'success': True, 'source': 'library', 'info': info})
+        
+        # Keep only a few lookups per request queued so concurrent batches share the pool
+        remaining = iter([normalized for normalized in positions if normalized not in known])
+        in_flight = {}
+        
+        def submit_more():
+            while len(in_flight) < app.config['BATCH_IN_FLIGHT']:
+                normalized = next(remaining, None)
+                if normalized is None:
+                    return
+                in_flight[batch_executor.submit(fetch_video_info, normalized, fields)] = normalized
+        
+        try:
+            submit_more()
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    normalized = in_flight.pop(future)
+                    try:
+                        result = {'success': True, 'source': 'youtube', 'info': future.result()}
+                    except Exception as e:
+                        logger.error(f"Error fetching video info for {normalized}: {str(e)}")
+                        result = {'success': False, 'error': str(e)}
+                    yield from lines(normalized, result)
+                submit_more()
+        finally:
+            # Client went away or we are done: drop anything not yet started
+            for future in in_flight:
+                future.cancel()
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
 
 def ensure_ffmpeg():
     """Check if FFmpeg is installed, if not attempt to download and install it"""
@@ -376,11 +1123,26 @@ def ensure_ffmpeg():
             logger.error("Automatic FFmpeg installation only supported on Windows")
             return False
 
+_ffmpeg_location = None
+
+def resolve_ffmpeg_location():
+    """Directory holding ffmpeg, installing it first if needed; cached once found"""
+    global _ffmpeg_location
+    if _ffmpeg_location is None and ensure_ffmpeg():
+        ffmpeg_path = shutil.which('ffmpeg')
+        if ffmpeg_path:
+            _ffmpeg_location = os.path.dirname(ffmpeg_path)
+    return _ffmpeg_location
+
+# Resolve ffmpeg before serving, then pick up jobs a previous process left behind
+resolve_ffmpeg_location()
+recover_unfinished_jobs()
+
 @app.route('/api/download', methods=['POST'])
 @rate_limit(limit=3, per=60)
 def download_from_youtube():
-    # Check for FFmpeg
-    if not ensure_ffmpeg():
+    # Check for FFmpeg; only a missing install is looked up again, off the event loop
+    if not (_ffmpeg_location or download_executor.submit(resolve_ffmpeg_location).result()):
         return jsonify({
             'error': 'FFmpeg required',
             'message': 'Could not automatically install FFmpeg. Please install manually from https://ffmpeg.org/'
@@ -398,157 +1160,48 @@ def download_from_youtube():
     if not url:
         return jsonify({'error': 'URL is required'}), 400
     
+    job_id = None
     try:
         # Clean URL
         url = url.replace('%3D', '=').replace('%26', '&')
         
         # Get video info first to determine title
         ydl_info = yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': True})
-        info = ydl_info.extract_info(url, download=False)
+        info = info_executor.submit(ydl_info.extract_info, url, download=False).result()
         
-        # Generate filename
-        safe_title = secure_filename(re.sub(r'[^\w\-_\. ]', '', info.get('title', 'video')))
-        unique_id = str(uuid.uuid4())[:8]
+        # Generate filename; the job id suffix keeps each job's files apart on disk
+        job_id = str(uuid.uuid4())
+        media_id = str(uuid.uuid4())
+        unique_id = job_id[:8]
         if not filename:
+            safe_title = secure_filename(re.sub(r'[^\w\-_\. ]', '', info.get('title', 'video')))
             filename = f"{safe_title}_{unique_id}"
         else:
-            filename = secure_filename(filename)
+            filename = f"{secure_filename(filename)}_{unique_id}"
         
-        # Set download options
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'outtmpl': os.path.join(
-                app.config['AUDIO_FOLDER' if download_type == 'audio' else 'VIDEO_FOLDER'],
-                filename + '.%(ext)s'
-            ),
-            'postprocessors': [],
-            'merge_output_format': 'mp4',
-            'writethumbnail': True,
-            'ffmpeg_location': os.path.dirname(subprocess.check_output(['which', 'ffmpeg']).decode().strip())
-        }
-        
-        # Configure format selection
-        if download_type == 'audio':
-            ydl_opts.update({
-                'format': 'bestaudio/best',
-                'postprocessors': [
-                    {
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    },
-                    {
-                        'key': 'FFmpegMetadata',
-                        'add_metadata': True
-                    }
-                ]
-            })
-        else:
-            if quality == 'highest':
-                ydl_opts['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-            else:
-                res = quality.replace('p', '')
-                ydl_opts['format'] = f'bestvideo[height<={res}][ext=mp4]+bestaudio[ext=m4a]/best[height<={res}][ext=mp4]/best'
-        
-        # Handle video trimming
-        if trim_start or trim_end:
-            def parse_time(time_str):
-                parts = list(map(int, time_str.split(':')))
-                if len(parts) == 3:  # HH:MM:SS
-                    return parts[0] * 3600 + parts[1] * 60 + parts[2]
-                elif len(parts) == 2:  # MM:SS
-                    return parts[0] * 60 + parts[1]
-                return int(time_str)  # SS
-            
-            if trim_start and trim_end:
-                ydl_opts['postprocessors'].append({
-                    'key': 'FFmpegVideoConvertor',
-                    'preferedformat': 'mp4',
-                    'when': 'before_dl',
-                    'pre_opts': [
-                        '-ss', str(parse_time(trim_start)),
-                        '-to', str(parse_time(trim_end))
-                    ]
-                })
-            elif trim_start:
-                ydl_opts['postprocessors'].append({
-                    'key': 'FFmpegVideoConvertor',
-                    'preferedformat': 'mp4',
-                    'when': 'before_dl',
-                    'pre_opts': ['-ss', str(parse_time(trim_start))]
-                })
-            elif trim_end:
-                ydl_opts['postprocessors'].append({
-                    'key': 'FFmpegVideoConvertor',
-                    'preferedformat': 'mp4',
-                    'when': 'before_dl',
-                    'pre_opts': ['-to', str(parse_time(trim_end))]
-                })
-        
-        # Download the file
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            downloaded_file = ydl.prepare_filename(info)
-            
-            if download_type == 'audio':
-                downloaded_file = downloaded_file.replace('.webm', '.mp3').replace('.m4a', '.mp3')
-            
-            # Handle metadata and thumbnail
-            if include_metadata:
-                try:
-                    if download_type == 'audio':
-                        audio = MP3(downloaded_file, ID3=EasyID3)
-                        audio['title'] = info['title']
-                        audio['artist'] = info.get('uploader', 'Unknown')
-                        audio['album'] = 'YouTube Download'
-                        audio.save()
-                        
-                        # Add thumbnail
-                        audio = MP3(downloaded_file, ID3=ID3)
-                        thumb_path = downloaded_file.replace('.mp3', '.webp')
-                        if os.path.exists(thumb_path):
-                            with open(thumb_path, 'rb') as thumb_file:
-                                audio.tags.add(APIC(
-                                    encoding=3,
-                                    mime='image/webp',
-                                    type=3,
-                                    desc='Cover',
-                                    data=thumb_file.read()
-                                ))
-                                audio.save()
-                            os.remove(thumb_path)
-                    else:
-                        video = MP4(downloaded_file)
-                        video['\xa9nam'] = info['title']
-                        video['\xa9ART'] = info.get('uploader', 'Unknown')
-                        thumb_path = downloaded_file.replace('.mp4', '.webp')
-                        if os.path.exists(thumb_path):
-                            with open(thumb_path, 'rb') as thumb_file:
-                                video['covr'] = [MP4Cover(thumb_file.read(), imageformat=MP4Cover.FORMAT_JPEG)]
-                            os.remove(thumb_path)
-                        video.save()
-                except Exception as e:
-                    logger.warning(f"Metadata error: {str(e)}")
-        
-        # Add to database
-        media_id = str(uuid.uuid4())
-        media_data = {
-            'id': media_id,
-            'title': info['title'],
-            'author': info.get('uploader'),
-            'duration': info.get('duration'),
-            'size': os.path.getsize(downloaded_file),
-            'format': 'mp3' if download_type == 'audio' else 'mp4',
+        # Journal the job, including everything needed to re-run it, before any bytes hit the disk
+        job = {
+            'id': job_id,
+            'media_id': media_id,
+            'url': url,
             'type': download_type,
             'quality': quality,
+            'folder': app.config['AUDIO_FOLDER' if download_type == 'audio' else 'VIDEO_FOLDER'],
+            'filename': filename,
+            'title': info.get('title'),
+            'author': info.get('uploader'),
+            'duration': info.get('duration'),
             'thumbnail': info.get('thumbnail'),
-            'path': downloaded_file,
-            'youtube_id': info.get('id')
+            'youtube_id': info.get('id'),
+            'options': build_download_options(download_type, quality, trim_start, trim_end),
+            'metadata': include_metadata,
+            'stage': 'extracted'
         }
+        if not create_job(job):
+            return jsonify({'error': 'Could not start download. Please try again.'}), 500
         
-        if not add_media_to_db(media_data):
-            logger.error("Failed to add media to database")
+        # Download, tag and register the file on a native thread
+        info, downloaded_file = download_executor.submit(run_download_job, job).result()
         
         return jsonify({
             'success': True,
@@ -565,9 +1218,11 @@ def download_from_youtube():
         
     except yt_dlp.utils.DownloadError as e:
         logger.error(f"Download error: {str(e)}")
+        abort_job(job_id, str(e))
         return jsonify({'error': 'Failed to download video. YouTube may have blocked the request.'}), 500
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
+        abort_job(job_id, str(e))
         return jsonify({'error': str(e)}), 500
 
     
@@ -588,41 +1243,10 @@ def serve_media(media_id):
     }
     mimetype = mime_types.get(ext, 'application/octet-stream')
     
-    # Stream the file for playback
-    range_header = request.headers.get('Range', None)
-    if not range_header:
-        return send_file(media['path'], mimetype=mimetype)
-    
-    # Handle range requests for streaming
-    size = os.path.getsize(media['path'])
-    byte1, byte2 = 0, None
-    
-    range_ = range_header.split('=')[1]
-    if '-' in range_:
-        byte1, byte2 = range_.split('-')
-        byte1 = int(byte1)
-        if byte2:
-            byte2 = int(byte2)
-        else:
-            byte2 = size - 1
-    
-    length = byte2 - byte1 + 1 if byte2 else size - byte1
-    
-    with open(media['path'], 'rb') as f:
-        f.seek(byte1)
-        data = f.read(length)
-    
-    response = Response(
-        data,
-        206,
-        mimetype=mimetype,
-        direct_passthrough=True
-    )
-    
-    response.headers.add('Content-Range', f'bytes {byte1}-{byte2 if byte2 else size-1}/{size}')
-    response.headers.add('Accept-Ranges', 'bytes')
-    response.headers.add('Content-Length', str(length))
-    
+    # send_file answers Range requests itself and hands the open file to the
+    # server's file wrapper, so large media is never buffered in memory
+    response = send_file(media['path'], mimetype=mimetype, conditional=True)
+    response.headers['Accept-Ranges'] = 'bytes'
     return response
 
 @app.route('/download/<media_id>')
@@ -708,4 +1332,5 @@ def cleanup_files():
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
+    # Development server only; use `gunicorn -c gunicorn.conf.py wsgi:app` in production
     app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
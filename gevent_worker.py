@@ -0,0 +1,36 @@
+"""Gunicorn gevent worker that leaves `subprocess` and `os` unpatched.
+
+gevent's patched subprocess.Popen only works on the hub's default loop and
+raises "child watchers are only available on the default loop" when it is
+called from a native threadpool thread. yt-dlp and its ffmpeg postprocessors
+run on such threads (see make_executor() in app.py), so they need the real
+subprocess module. `os` has to stay unpatched too: with gevent's os.waitpid
+the real Popen hangs waiting for children it never registered. Nothing on
+the hub thread spawns processes once the app is serving.
+
+    worker_class = 'gevent_worker.GeventWorker'
+"""
+import warnings
+
+from gevent import monkey, socket
+from gunicorn.workers import ggevent
+
+
+def patch_all():
+    with warnings.catch_warnings():
+        # The warning is about SIGCHLD and gevent.subprocess, which is not used
+        warnings.simplefilter('ignore', monkey.MonkeyPatchWarning)
+        monkey.patch_all(subprocess=False, os=False)
+
+
+class GeventWorker(ggevent.GeventWorker):
+
+    def patch(self):
+        patch_all()
+
+        # patch sockets, as gunicorn's own gevent worker does
+        sockets = []
+        for s in self.sockets:
+            sockets.append(socket.socket(s.FAMILY, socket.SOCK_STREAM,
+                                         fileno=s.sock.detach()))
+        self.sockets = sockets
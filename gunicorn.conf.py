@@ -0,0 +1,61 @@
+"""Gunicorn settings for serving app.py in production.
+
+Concurrency model
+-----------------
+* Workers: a few gevent processes (WEB_CONCURRENCY, default one per CPU),
+  using gevent_worker.GeventWorker. That worker leaves `subprocess` and
+  `os` unpatched, because gevent's Popen fails on native threads and yt-dlp
+  starts ffmpeg from them.
+  Each one multiplexes up to `worker_connections` clients on an event loop,
+  so idle, slow or long-polling clients and open media streams cost a
+  greenlet rather than an OS thread.
+* Media: /media and /download go through send_file. Whole files go out via
+  gunicorn's sendfile(2) file wrapper. Range requests are read in chunks,
+  so neither path loads the file into memory.
+* CPU work: yt-dlp extraction (JSON parsing, the JS interpreter used for
+  signatures) and mutagen tagging would block the hub thread that all of a
+  worker's greenlets share. Under gevent they run on native-thread pools from
+  make_executor(). The request greenlet waits on the future cooperatively,
+  and requests beyond a pool's size queue.
+  - info_executor (INFO_WORKERS threads): /api/video-info and the title
+    lookup before a download.
+  - batch_executor (BATCH_WORKERS threads): /api/video-info/batch. Each
+    batch keeps at most BATCH_IN_FLIGHT lookups queued, so a large batch
+    neither starves other batches nor delays interactive lookups.
+  - download_executor (DOWNLOAD_WORKERS threads): the download, ffmpeg,
+    tag and register pipeline, and resumed jobs. ffmpeg is located once at
+    startup (resolve_ffmpeg_location()).
+* Batch lookups: the NDJSON response is streamed as pool results complete.
+  Futures that have not started are cancelled if the client disconnects.
+* Cleanup: only one worker on the host runs the hourly sweep. It is chosen
+  with a file lock, see start_background_tasks(). The sweep is a greenlet
+  doing short filesystem calls.
+* Job journal: each worker runs recover_unfinished_jobs() on import. A job
+  counts as orphaned when its owner's workers/<id>.lock is no longer flocked,
+  so pid reuse can't hide a dead owner. claim_job() is an atomic UPDATE, so
+  exactly one worker resumes or rolls back each orphaned job. Do not enable
+  preload_app: each worker must create its own id and lock after the fork.
+* SQLite: sqlite3 calls block the hub and gevent cannot make them
+  cooperative. WAL mode keeps readers from waiting on writers, so waits only
+  happen when two writers collide, and writes are short. Library and journal
+  writes wait up to DB_TIMEOUT (5 s) rather than fail. The per-request
+  rate-limit check uses RATE_LIMIT_DB_TIMEOUT (250 ms).
+* Rate limits: rate_limit() counts requests in the rate_limits table, so
+  the limits apply to the whole host, not to each worker. If the database
+  is busy the check fails open.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gevent_worker.GeventWorker'
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+
+# Downloads run inside the request, so allow them time to finish
+timeout = int(os.environ.get('TIMEOUT', 600))
+graceful_timeout = 60
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
@@ -0,0 +1,92 @@
+"""Smoke test for the production gevent worker.
+
+Monkey-patching cannot be undone, so the check runs in a child interpreter
+against a copy of app.py (its downloads/ folder and database then live in a
+temp dir instead of the checkout).
+"""
+import os
+import shutil
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip('gevent')
+pytest.importorskip('gunicorn')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SUBPROCESS_CHILD = textwrap.dedent('''
+    import sys
+    sys.path[:0] = [sys.argv[1], sys.argv[2]]
+
+    import gevent_worker
+    gevent_worker.patch_all()
+
+    import subprocess
+    import app
+
+    for executor in (app.download_executor, app.info_executor, app.batch_executor):
+        output = executor.submit(subprocess.check_output, [sys.executable, '-c', 'print("ok")']).result()
+        assert output.strip() == b'ok', output
+    print('done')
+''')
+
+
+DOWNLOAD_CHILD = textwrap.dedent('''
+    import sys
+    sys.path[:0] = [sys.argv[1], sys.argv[2]]
+
+    import gevent_worker
+    gevent_worker.patch_all()
+
+    import functools
+    import http.server
+    import os
+    import subprocess
+    import threading
+    import app
+
+    www = os.path.join(sys.argv[1], 'www')
+    os.makedirs(www)
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', 'sine=duration=2',
+                    '-c:a', 'aac', os.path.join(www, 'clip.m4a')], check=True)
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=www)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    job = {
+        'id': 'smoke-job', 'media_id': 'smoke-media',
+        'url': f'http://127.0.0.1:{server.server_port}/clip.m4a',
+        'type': 'audio', 'quality': 'best', 'folder': app.app.config['AUDIO_FOLDER'],
+        'filename': 'clip_smoke', 'title': 'Clip', 'author': None, 'duration': None,
+        'thumbnail': None, 'youtube_id': None, 'metadata': True, 'stage': 'extracted',
+        'options': app.build_download_options('audio', 'best')
+    }
+    assert app.create_job(job)
+    info, path = app.download_executor.submit(app.run_download_job, job).result()
+    assert path.endswith('.mp3') and os.path.exists(path), path
+    assert app.get_job('smoke-job')['status'] == 'done'
+    assert app.get_media_from_db('smoke-media')['path'] == path
+    print('done')
+''')
+
+
+def run_child(script, tmp_path):
+    shutil.copy(os.path.join(ROOT, 'app.py'), tmp_path)
+    result = subprocess.run(
+        [sys.executable, '-c', script, str(tmp_path), ROOT],
+        cwd=tmp_path, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().endswith('done')
+
+
+def test_subprocess_works_on_executors_under_gevent(tmp_path):
+    run_child(SUBPROCESS_CHILD, tmp_path)
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg not installed')
+def test_run_download_job_under_gevent(tmp_path):
+    run_child(DOWNLOAD_CHILD, tmp_path)
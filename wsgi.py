@@ -0,0 +1,11 @@
+"""Production entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The gevent worker monkey-patches the standard library before this module is
+imported, so the app code stays synchronous while sockets, sleeps, subprocess
+pipes and threads become cooperative greenlets.
+"""
+from app import app
+
+application = app